@@ -10,15 +10,24 @@ import logging
 import os
 import smtplib
 import sqlite3
+import string
 import sys
 import time
-from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
 
+import numpy as np
+import orjson
 import requests
-from shapely.geometry import Point, shape
+import shapely
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from shapely.geometry import shape
 
 # Configuration
 CONFIG = {
@@ -43,12 +52,24 @@ CONFIG = {
     'check_interval_seconds': 300,
     'log_file': 'ais_monitor.log',
     'db_file': 'ais_trails.db',
-    'trail_hours': 3
+    'metadata_cache': '.vessel_metadata.json',
+    'metadata_ttl_hours': 24,
+    'trail_hours': 3,
+    'cleanup_interval_seconds': 3600
 }
 
 # Global cache for vessel metadata
 _vessel_metadata = {}
 
+# Shared HTTP session so polls reuse the TCP/TLS connection to digitraffic
+_session = requests.Session()
+_session.headers.update({'Accept-Encoding': 'gzip'})
+_session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+))
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -59,6 +80,8 @@ logging.basicConfig(
 )
 
 class Vessel:
+    __slots__ = ('mmsi', 'name', 'lat', 'lon', 'sog', 'cog', 'heading', 'timestamp')
+    
     def __init__(self, data):
         self.mmsi = data.get('mmsi', 0)
         self.name = data.get('name') or f'MMSI-{self.mmsi}'
@@ -83,13 +106,27 @@ class Vessel:
             }
         }
 
-def fetch_vessel_metadata():
-    """Fetch vessel metadata (names, types, etc.) from digitraffic API"""
+def fetch_vessel_metadata(cache=None):
+    """Fetch vessel metadata (names, types, etc.) from digitraffic API
+    
+    With a previous cache record the request is conditional (ETag /
+    Last-Modified); on 304 Not Modified that record is returned as-is.
+    """
+    headers = {}
+    if cache:
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+    
     try:
         logging.info("Fetching vessel metadata...")
-        response = requests.get(CONFIG['vessels_url'], timeout=60)
+        response = _session.get(CONFIG['vessels_url'], headers=headers, timeout=60)
+        if response.status_code == 304:
+            logging.info("Vessel metadata not modified")
+            return cache
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         metadata = {}
         if isinstance(data, list):
@@ -106,79 +143,152 @@ def fetch_vessel_metadata():
                     }
         
         logging.info(f"Loaded metadata for {len(metadata)} vessels")
-        return metadata
+        return {
+            'fetched_at': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'vessels': metadata
+        }
     
     except Exception as e:
         logging.error(f"Error fetching vessel metadata: {e}")
         return {}
 
+def load_cached_metadata():
+    """Load the vessel metadata cache record from disk"""
+    cache_path = Path(__file__).parent / CONFIG['metadata_cache']
+    try:
+        cache = orjson.loads(cache_path.read_bytes())
+        # JSON object keys are strings, MMSIs are ints everywhere else
+        cache['vessels'] = {int(mmsi): info for mmsi, info in cache['vessels'].items()}
+        cache['fetched_at'] = float(cache.get('fetched_at') or 0)
+        logging.info(f"Loaded cached metadata for {len(cache['vessels'])} vessels")
+        return cache
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.warning(f"Ignoring vessel metadata cache: {e}")
+        return {}
+
+def save_cached_metadata(cache):
+    """Atomically write the vessel metadata cache record to disk"""
+    if not cache or not cache['vessels']:
+        return
+    cache_path = Path(__file__).parent / CONFIG['metadata_cache']
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    try:
+        tmp_path.write_bytes(orjson.dumps(cache, option=orjson.OPT_NON_STR_KEYS))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Could not write vessel metadata cache: {e}")
+
+def get_vessel_metadata():
+    """Vessel metadata from the disk cache, revalidated with the API after the TTL"""
+    cache = load_cached_metadata()
+    # Age comes from the record itself, checkouts and CI cache restores reset mtimes
+    if cache and (time.time() - cache['fetched_at']) / 3600 <= CONFIG['metadata_ttl_hours']:
+        return cache['vessels']
+    
+    fresh = fetch_vessel_metadata(cache)
+    if fresh is cache:
+        # Not modified: keep the vessels, just restart the TTL
+        fresh['fetched_at'] = time.time()
+        save_cached_metadata(fresh)
+    elif fresh:
+        save_cached_metadata(fresh)
+    else:
+        # Fetch failed, stale names are better than none
+        fresh = cache
+    return fresh.get('vessels', {})
+
+def collect_metadata(future):
+    """Result of a background metadata load, {} if it failed"""
+    try:
+        return future.result()
+    except Exception as e:
+        logging.error(f"Error loading vessel metadata: {e}")
+        return {}
+
+def is_valid_point(feature):
+    """Point feature with numeric lon/lat and an integer-like timestampExternal"""
+    if not isinstance(feature, dict):
+        return False
+    geom = feature.get('geometry') or {}
+    props = feature.get('properties') or {}
+    if not isinstance(geom, dict) or not isinstance(props, dict):
+        return False
+    coords = geom.get('coordinates')
+    ts = props.get('timestampExternal') or 0
+    return (geom.get('type') == 'Point'
+            and isinstance(coords, list) and len(coords) >= 2
+            and all(isinstance(c, (int, float)) for c in coords[:2])
+            and isinstance(ts, (int, float)) and 0 <= ts < 2**63)
+
 def fetch_vessels():
     """Fetch ALL vessels from digitraffic.fi in Gulf of Finland"""
     global _vessel_metadata
     
-    # Refresh metadata if empty or stale (refresh every run)
+    # Load metadata once per process (disk cache or API), overlapping the AIS request
+    pending_metadata = None
     if not _vessel_metadata:
-        _vessel_metadata = fetch_vessel_metadata()
+        pool = ThreadPoolExecutor(max_workers=1)
+        pending_metadata = pool.submit(get_vessel_metadata)
+        pool.shutdown(wait=False)
     
     try:
         logging.info("Fetching AIS data...")
-        response = requests.get(CONFIG['ais_url'], timeout=30)
+        response = _session.get(CONFIG['ais_url'], timeout=30)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         if not data or 'features' not in data:
             logging.warning("No data from API")
             return []
         
-        vessels = []
+        # Keep only well-formed point features, then filter them as arrays
+        features = [f for f in data['features'] if is_valid_point(f)]
+        n = len(features)
+        lon = np.fromiter((f['geometry']['coordinates'][0] for f in features),
+                          dtype=np.float64, count=n)
+        lat = np.fromiter((f['geometry']['coordinates'][1] for f in features),
+                          dtype=np.float64, count=n)
+        ts = np.fromiter(((f.get('properties') or {}).get('timestampExternal') or 0
+                          for f in features), dtype=np.int64, count=n)
+        
+        # Filter: only in bbox, and only vessels with recent data (using timestampExternal)
         bbox = CONFIG['bbox']
+        now_ms = int(time.time() * 1000)
+        max_age_ms = CONFIG['max_age_minutes'] * 60 * 1000
+        mask = ((lat >= bbox['latmin']) & (lat <= bbox['latmax']) &
+                (lon >= bbox['lonmin']) & (lon <= bbox['lonmax']) &
+                ((ts == 0) | (now_ms - ts <= max_age_ms)))
+        
+        if pending_metadata is not None:
+            future, pending_metadata = pending_metadata, None
+            _vessel_metadata = collect_metadata(future)
         
-        for feature in data['features']:
-            try:
-                geom = feature.get('geometry', {})
-                props = feature.get('properties', {})
-                
-                if geom.get('type') != 'Point':
-                    continue
-                
-                coords = geom.get('coordinates', [])
-                if len(coords) < 2:
-                    continue
-                
-                lon, lat = coords[0], coords[1]
-                
-                # Filter: only in bbox
-                if not (bbox['latmin'] <= lat <= bbox['latmax'] and 
-                        bbox['lonmin'] <= lon <= bbox['lonmax']):
-                    continue
-                
-                mmsi = props.get('mmsi', 0)
-                timestamp_ext = props.get('timestampExternal', 0)
-                
-                # Filter: only vessels with recent data (using timestampExternal)
-                if timestamp_ext:
-                    age_minutes = (time.time() - timestamp_ext / 1000) / 60
-                    if age_minutes > CONFIG['max_age_minutes']:
-                        continue
-                
-                # Get name from metadata if available, otherwise use API name
-                vessel_name = props.get('name')
-                if mmsi in _vessel_metadata and _vessel_metadata[mmsi]['name']:
-                    vessel_name = _vessel_metadata[mmsi]['name']
-                
-                vessels.append(Vessel({
-                    'mmsi': mmsi,
-                    'name': vessel_name,
-                    'lat': lat,
-                    'lon': lon,
-                    'sog': props.get('sog', 0),
-                    'cog': props.get('cog', 0),
-                    'heading': props.get('heading', 0),
-                    'timestamp': props.get('timestampExternal', 0)
-                }))
+        vessels = []
+        for i in np.flatnonzero(mask):
+            geom = features[i]['geometry']
+            props = features[i].get('properties') or {}
+            lon_i, lat_i = geom['coordinates'][0], geom['coordinates'][1]
+            mmsi = props.get('mmsi', 0)
+            
+            # Get name from metadata if available, otherwise use API name
+            vessel_name = props.get('name')
+            if mmsi in _vessel_metadata and _vessel_metadata[mmsi]['name']:
+                vessel_name = _vessel_metadata[mmsi]['name']
             
-            except (ValueError, TypeError, KeyError):
-                continue
+            vessels.append(Vessel({
+                'mmsi': mmsi,
+                'name': vessel_name,
+                'lat': lat_i,
+                'lon': lon_i,
+                'sog': props.get('sog', 0),
+                'cog': props.get('cog', 0),
+                'heading': props.get('heading', 0),
+                'timestamp': props.get('timestampExternal', 0)
+            }))
         
         logging.info(f"Found {len(vessels)} vessels in Gulf of Finland")
         return vessels
@@ -186,6 +296,11 @@ def fetch_vessels():
     except Exception as e:
         logging.error(f"Error fetching AIS: {e}")
         return []
+    
+    finally:
+        # AIS fetch failed before the metadata was picked up, keep it for next cycle
+        if pending_metadata is not None:
+            _vessel_metadata = collect_metadata(pending_metadata)
 
 def load_geofence(geojson_path):
     """Load polygon from GeoJSON"""
@@ -196,6 +311,7 @@ def load_geofence(geojson_path):
         if data['type'] == 'FeatureCollection' and data['features']:
             feature = data['features'][0]
             polygon = shape(feature['geometry'])
+            shapely.prepare(polygon)
             name = feature['properties'].get('name', 'Unknown')
             logging.info(f"Loaded geofence: {name}")
             return polygon
@@ -204,15 +320,36 @@ def load_geofence(geojson_path):
         logging.error(f"Cannot load geofence: {e}")
         raise
 
+def connect_db():
+    """Open trail database (WAL journal, NORMAL sync; pragmas are per-connection)"""
+    db_path = Path(__file__).parent / CONFIG['db_file']
+    # Autocommit mode: writers manage their own BEGIN/COMMIT
+    conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
+
 def init_db():
-    """Initialize SQLite database for trail tracking"""
+    """Initialize SQLite database for trail tracking, return the long-lived connection"""
     db_path = Path(__file__).parent / CONFIG['db_file']
-    conn = sqlite3.connect(db_path)
+    conn = connect_db()
     cursor = conn.cursor()
+    
+    # Older databases store ISO-8601 TEXT timestamps, convert them to unix ms
+    columns = {row[1]: row[2] for row in cursor.execute('PRAGMA table_info(positions)')}
+    legacy = columns.get('timestamp') == 'TEXT'
+    
+    cursor.execute('BEGIN IMMEDIATE')
+    if legacy:
+        cursor.execute('ALTER TABLE positions RENAME TO positions_legacy')
+        cursor.execute('DROP INDEX IF EXISTS idx_mmsi')
+        cursor.execute('DROP INDEX IF EXISTS idx_timestamp')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS positions (
             mmsi INTEGER,
-            timestamp TEXT,
+            timestamp INTEGER,
             lat REAL,
             lon REAL,
             sog REAL,
@@ -222,75 +359,88 @@ def init_db():
     ''')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_mmsi ON positions(mmsi)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON positions(timestamp)')
+    if legacy:
+        cursor.execute('''
+            INSERT OR REPLACE INTO positions 
+            SELECT mmsi, CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER),
+                   lat, lon, sog, cog
+            FROM positions_legacy
+        ''')
+        converted = cursor.rowcount
+        cursor.execute('DROP TABLE positions_legacy')
+        logging.info(f"Converted {converted} stored positions to unix ms timestamps")
     conn.commit()
-    conn.close()
     logging.info(f"Database ready: {db_path}")
+    return conn
+
+def trail_cutoff():
+    """Oldest timestamp (unix ms) that still belongs to a trail"""
+    return int((time.time() - CONFIG['trail_hours'] * 3600) * 1000)
+
+def format_timestamp(ts_ms):
+    """Unix ms as naive UTC ISO-8601, the format the map expects"""
+    return datetime.fromtimestamp(ts_ms / 1000, timezone.utc).replace(tzinfo=None).isoformat(timespec='milliseconds')
 
-def save_positions(vessels):
-    """Save vessel positions to database"""
+_last_cleanup = 0
+
+def save_positions(vessels, conn):
+    """Save vessel positions to database, pruning old ones once per cleanup interval"""
+    global _last_cleanup
+    
     if not vessels:
         return
     
-    db_path = Path(__file__).parent / CONFIG['db_file']
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    now = datetime.utcnow().isoformat()
-    
-    for v in vessels:
-        try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO positions 
-                (mmsi, timestamp, lat, lon, sog, cog)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (v.mmsi, now, v.lat, v.lon, v.sog, v.cog))
-        except Exception as e:
-            logging.debug(f"Error saving MMSI {v.mmsi}: {e}")
-    
-    conn.commit()
+    now = int(time.time() * 1000)
+    cleanup = time.time() - _last_cleanup > CONFIG['cleanup_interval_seconds']
+    rows = [(v.mmsi, now, v.lat, v.lon, v.sog, v.cog) for v in vessels]
     
-    # Cleanup old positions
-    cutoff = (datetime.utcnow() - timedelta(hours=CONFIG['trail_hours'])).isoformat()
-    cursor.execute('DELETE FROM positions WHERE timestamp < ?', (cutoff,))
-    deleted = cursor.rowcount
-    conn.commit()
-    conn.close()
+    cursor = conn.cursor()
+    try:
+        # One write transaction for the whole batch and the cleanup
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.executemany('''
+            INSERT OR REPLACE INTO positions 
+            (mmsi, timestamp, lat, lon, sog, cog)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+        
+        # Cleanup old positions
+        deleted = 0
+        if cleanup:
+            cursor.execute('DELETE FROM positions WHERE timestamp < ?', (trail_cutoff(),))
+            deleted = cursor.rowcount
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Error saving positions: {e}")
+        return
     
+    if cleanup:
+        _last_cleanup = time.time()
     if deleted > 0:
         logging.info(f"Saved positions, cleaned {deleted} old records")
 
-def build_trails():
+def build_trails(conn):
     """Build trail GeoJSON from database"""
-    db_path = Path(__file__).parent / CONFIG['db_file']
-    if not db_path.exists():
-        return {'type': 'FeatureCollection', 'features': []}
-    
-    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
-    # Get all MMSIs with multiple positions
+    # Single ordered scan, served by the (mmsi, timestamp) primary key index.
+    # Cleanup is periodic, so drop positions that already aged out of the trail.
     cursor.execute('''
-        SELECT mmsi, COUNT(*) as cnt 
+        SELECT mmsi, lon, lat, timestamp 
         FROM positions 
-        GROUP BY mmsi 
-        HAVING cnt > 1
-    ''')
-    mmsis = [row[0] for row in cursor.fetchall()]
+        WHERE timestamp >= ?
+        ORDER BY mmsi, timestamp
+    ''', (trail_cutoff(),))
     
     features = []
-    for mmsi in mmsis:
-        cursor.execute('''
-            SELECT lat, lon, timestamp 
-            FROM positions 
-            WHERE mmsi = ? 
-            ORDER BY timestamp
-        ''', (mmsi,))
-        
-        positions = cursor.fetchall()
+    for mmsi, group in groupby(cursor, key=itemgetter(0)):
+        positions = list(group)
         if len(positions) < 2:
             continue
         
-        coordinates = [[lon, lat] for lat, lon, _ in positions]
+        # Columns are already in GeoJSON (lon, lat) order, orjson writes tuples as arrays
+        coordinates = [row[1:3] for row in positions]
         
         features.append({
             'type': 'Feature',
@@ -298,82 +448,119 @@ def build_trails():
             'properties': {
                 'mmsi': mmsi,
                 'points': len(positions),
-                'start': positions[0][2],
-                'end': positions[-1][2]
+                'start': format_timestamp(positions[0][3]),
+                'end': format_timestamp(positions[-1][3])
             }
         })
     
-    conn.close()
     return {'type': 'FeatureCollection', 'features': features}
 
 def check_geofence(vessels, polygon):
     """Return vessels inside polygon with speed above threshold"""
     breaches = []
+    if not vessels:
+        return breaches
     min_speed = CONFIG['email']['min_speed_knots']
     
-    for v in vessels:
-        if polygon.contains(Point(v.lon, v.lat)):
-            if v.sog < min_speed:
-                logging.info(f"SKIP: {v.name} (MMSI {v.mmsi}) in area but stationary (speed: {v.sog} knots)")
-            else:
-                breaches.append(v)
-                logging.warning(f"BREACH: {v.name} (MMSI {v.mmsi}) in restricted area (speed: {v.sog} knots)")
+    lon = np.fromiter((v.lon for v in vessels), dtype=float, count=len(vessels))
+    lat = np.fromiter((v.lat for v in vessels), dtype=float, count=len(vessels))
+    
+    # Index vessel points once per cycle: the tree query rejects by envelope,
+    # then runs the exact test only for candidates (works for MultiPolygons too)
+    tree = shapely.STRtree(shapely.points(lon, lat))
+    inside = np.sort(tree.query(polygon, predicate='contains'))
+    
+    for i in inside:
+        v = vessels[i]
+        if v.sog < min_speed:
+            logging.info(f"SKIP: {v.name} (MMSI {v.mmsi}) in area but stationary (speed: {v.sog} knots)")
+        else:
+            breaches.append(v)
+            logging.warning(f"BREACH: {v.name} (MMSI {v.mmsi}) in restricted area (speed: {v.sog} knots)")
     return breaches
 
-_alert_cache = {}
+# Last alert time per MMSI, oldest first so expired entries can be pruned from the front
+_alert_cache = OrderedDict()
+
+_ALERT_SUBJECT = string.Template("ALERT: $name entered restricted area")
+_ALERT_BODY = string.Template("""
+VESSEL BREACH ALERT
+
+Vessel: $name
+MMSI: $mmsi
+Position: $lat, $lon
+Speed: $sog knots
+Course: $cog degrees
 
-def send_alert(vessel):
-    """Send email alert with cooldown"""
+MarineTraffic: https://www.marinetraffic.com/en/ais/details/ships/mmsi:$mmsi
+VesselFinder: https://www.vesselfinder.com/?mmsi=$mmsi
+
+---
+Automated AIS Monitor
+""")
+
+def build_alert_message(vessel):
+    """Build the breach alert email for a vessel"""
+    email_cfg = CONFIG['email']
+    fields = {
+        'name': vessel.name,
+        'mmsi': vessel.mmsi,
+        'lat': f'{vessel.lat:.6f}',
+        'lon': f'{vessel.lon:.6f}',
+        'sog': vessel.sog,
+        'cog': vessel.cog
+    }
+    
+    msg = EmailMessage()
+    msg['From'] = email_cfg['sender']
+    msg['To'] = email_cfg['recipient']
+    msg['Subject'] = _ALERT_SUBJECT.substitute(fields)
+    msg.set_content(_ALERT_BODY.substitute(fields), charset='utf-8')
+    return msg
+
+def send_alerts(vessels):
+    """Send email alerts with cooldown, all over one SMTP session"""
     now = time.time()
     cooldown = CONFIG['email']['cooldown_hours'] * 3600
     
-    if vessel.mmsi in _alert_cache:
-        if now - _alert_cache[vessel.mmsi] < cooldown:
+    # Drop entries whose cooldown has expired to keep the cache bounded
+    while _alert_cache and next(iter(_alert_cache.values())) <= now - cooldown:
+        _alert_cache.popitem(last=False)
+    
+    pending = []
+    queued = set()
+    for vessel in vessels:
+        # A repeated MMSI in one batch (e.g. vessels without one default to 0) counts as cooldown too
+        if vessel.mmsi in queued or (
+                vessel.mmsi in _alert_cache and now - _alert_cache[vessel.mmsi] < cooldown):
             logging.info(f"Cooldown active for MMSI {vessel.mmsi}")
-            return False
+            continue
+        queued.add(vessel.mmsi)
+        pending.append(vessel)
+    if not pending:
+        return 0
     
     email_cfg = CONFIG['email']
     if not email_cfg['password']:
         logging.warning("Email not configured")
-        return False
+        return 0
     
+    sent = 0
     try:
-        msg = MIMEMultipart()
-        msg['From'] = email_cfg['sender']
-        msg['To'] = email_cfg['recipient']
-        msg['Subject'] = f"ALERT: {vessel.name} entered restricted area"
-        
-        body = f"""
-VESSEL BREACH ALERT
-
-Vessel: {vessel.name}
-MMSI: {vessel.mmsi}
-Position: {vessel.lat:.6f}, {vessel.lon:.6f}
-Speed: {vessel.sog} knots
-Course: {vessel.cog} degrees
-
-MarineTraffic: https://www.marinetraffic.com/en/ais/details/ships/mmsi:{vessel.mmsi}
-VesselFinder: https://www.vesselfinder.com/?mmsi={vessel.mmsi}
-
----
-Automated AIS Monitor
-"""
-        msg.attach(MIMEText(body, 'plain', 'utf-8'))
-        
         with smtplib.SMTP(email_cfg['smtp_server'], email_cfg['smtp_port']) as server:
             server.starttls()
             server.login(email_cfg['sender'], email_cfg['password'])
-            server.send_message(msg)
-        
-        _alert_cache[vessel.mmsi] = now
-        logging.info(f"Alert sent for MMSI {vessel.mmsi}")
-        return True
-    
+            for vessel in pending:
+                server.send_message(build_alert_message(vessel))
+                _alert_cache[vessel.mmsi] = now
+                _alert_cache.move_to_end(vessel.mmsi)
+                sent += 1
+                logging.info(f"Alert sent for MMSI {vessel.mmsi}")
     except Exception as e:
         logging.error(f"Email error: {e}")
-        return False
+    return sent
 
-def export_geojson(vessels, out_dir):
+def export_geojson(vessels, out_dir, conn):
     """Write vessels.geojson, trails.geojson, restricted.geojson and fixed_points.geojson"""
     out_dir.mkdir(parents=True, exist_ok=True)
     
@@ -382,16 +569,14 @@ def export_geojson(vessels, out_dir):
         'type': 'FeatureCollection',
         'features': [v.to_geojson_feature() for v in vessels]
     }
-    (out_dir / 'vessels.geojson').write_text(
-        json.dumps(vessels_fc, ensure_ascii=False, indent=2), 
-        encoding='utf-8'
+    (out_dir / 'vessels.geojson').write_bytes(
+        orjson.dumps(vessels_fc, option=orjson.OPT_SERIALIZE_NUMPY)
     )
     
     # Trails
-    trails_fc = build_trails()
-    (out_dir / 'trails.geojson').write_text(
-        json.dumps(trails_fc, ensure_ascii=False, indent=2),
-        encoding='utf-8'
+    trails_fc = build_trails(conn)
+    (out_dir / 'trails.geojson').write_bytes(
+        orjson.dumps(trails_fc, option=orjson.OPT_SERIALIZE_NUMPY)
     )
     
     # Restricted area
@@ -420,14 +605,11 @@ def export_geojson(vessels, out_dir):
                 for pt in CONFIG['fixed_points']
             ]
         }
-        (out_dir / 'fixed_points.geojson').write_text(
-            json.dumps(fixed_points_fc, ensure_ascii=False, indent=2),
-            encoding='utf-8'
-        )
+        (out_dir / 'fixed_points.geojson').write_bytes(orjson.dumps(fixed_points_fc))
     
     logging.info(f"Exported GeoJSON to {out_dir} (trails: {len(trails_fc['features'])})")
 
-def run_check(polygon):
+def run_check(polygon, conn):
     """Single monitoring cycle"""
     logging.info("--- Starting check ---")
     
@@ -437,21 +619,20 @@ def run_check(polygon):
         return
     
     # Save positions to database for trail tracking
-    save_positions(vessels)
+    save_positions(vessels, conn)
     
     breaches = check_geofence(vessels, polygon)
     
     # Export for map
-    export_geojson(vessels, Path(CONFIG['export_dir']))
+    export_geojson(vessels, Path(CONFIG['export_dir']), conn)
     
     # Send alerts
-    for vessel in breaches:
-        send_alert(vessel)
+    send_alerts(breaches)
     
     if not breaches:
         logging.info("No breaches detected")
 
-def monitor_loop(polygon):
+def monitor_loop(polygon, conn):
     """Continuous monitoring"""
     logging.info("Starting continuous monitoring...")
     logging.info(f"Geofence: {CONFIG['geofence']}")
@@ -459,7 +640,7 @@ def monitor_loop(polygon):
     
     while True:
         try:
-            run_check(polygon)
+            run_check(polygon, conn)
             time.sleep(CONFIG['check_interval_seconds'])
         except KeyboardInterrupt:
             logging.info("Stopped by user")
@@ -471,12 +652,16 @@ def monitor_loop(polygon):
 if __name__ == '__main__':
     geofence_path = Path(__file__).parent / CONFIG['geofence']
     polygon = load_geofence(geofence_path)
-    init_db()
+    conn = init_db()
     
-    if '--once' in sys.argv:
-        run_check(polygon)
-    else:
-        monitor_loop(polygon)
+    try:
+        if '--once' in sys.argv:
+            run_check(polygon, conn)
+        else:
+            monitor_loop(polygon, conn)
+    finally:
+        # Closing checkpoints the WAL back into the committed .db file
+        conn.close()
 
 
 